@@ -5,6 +5,14 @@ import requests
 import os
 import uuid
 import json # JSON module for parsing tags in get_random_waifu
+import sys
+import asyncio
+import hashlib
+import signal
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit, urlunsplit
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 import psycopg2
@@ -16,10 +24,18 @@ from telegram.ext import (
     ContextTypes,
     filters,
     CallbackQueryHandler,
-    InlineQueryHandler
+    InlineQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop
 )
 from telegram.constants import ParseMode
 from telegram.error import BadRequest
+import tornado.web
+
+try:
+    from PIL import Image # Thumbnails ke liye optional; na ho toh full image hi thumbnail banegi
+except ImportError:
+    Image = None
 
 # --- CONFIGURATION (LOAD FROM .ENV) ---
 load_dotenv()
@@ -31,7 +47,51 @@ PORT = int(os.environ.get('PORT', '8443'))
 WEBHOOK_URL = os.getenv("WEBHOOK_URL") 
 
 SPAWN_THRESHOLD = 100 
-current_spawns = {} 
+SPAWN_TTL_SECONDS = int(os.getenv("SPAWN_TTL_SECONDS", "600")) # Itni der mein grab na ho toh waifu bhaag jaati hai
+SPAWN_SWEEP_INTERVAL = int(os.getenv("SPAWN_SWEEP_INTERVAL", "30"))
+current_spawns = {} # chat_id -> SpawnRecord (sirf unclaimed, active spawns)
+spawn_registry_metrics = {'spawned': 0, 'claimed': 0, 'expired': 0}
+
+# Thumbnail cache (inline gallery ke liye chhote JPEG/WebP)
+THUMB_DIR = os.getenv("THUMB_DIR", "thumbs")
+THUMB_URL_PATH = "thumbs"
+THUMB_SIZE = int(os.getenv("THUMB_SIZE", "320"))
+THUMB_FORMAT = os.getenv("THUMB_FORMAT", "JPEG").upper() # JPEG ya WEBP
+THUMB_CACHE_MAX_BYTES = int(os.getenv("THUMB_CACHE_MAX_MB", "200")) * 1024 * 1024
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "4"))
+thumb_executor = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="thumb")
+THUMB_FAILURE_TTL = int(os.getenv("THUMB_FAILURE_TTL", "3600")) # Fail hui image ko itni der dobara try nahi karte
+thumbs_in_flight = set() # image_url jinka thumbnail abhi ban raha hai
+thumb_failures = {} # image_url -> retry allowed after (monotonic time)
+thumb_cache_lock = threading.Lock() # Eviction aur cache size ek thread mein ek baar
+thumb_cache_bytes = None # Cache ka running total (pehli baar scan se bharta hai)
+
+# Spawn worker pool (message handler ke bahar spawns chalane ke liye)
+SPAWN_WORKERS = int(os.getenv("SPAWN_WORKERS", "4"))
+SPAWN_QUEUE_SIZE = int(os.getenv("SPAWN_QUEUE_SIZE", "100"))
+SPAWN_TIMEOUT_SECONDS = int(os.getenv("SPAWN_TIMEOUT_SECONDS", "60")) # Ek spawn worker ko itni der se zyada nahi rokta
+SPAWN_OVERLOAD_POLICY = os.getenv("SPAWN_OVERLOAD_POLICY", "delay").lower() # "drop" ya "delay"
+spawn_queue = None # asyncio.Queue, run_webhook_server mein banta hai
+spawn_worker_tasks = []
+pending_spawn_chats = set() # Queue mein ya chal rahe spawns wale chats
+
+# Admission control (handlers se pehle in-memory token buckets, DB touch kiye bina)
+USER_RATE = float(os.getenv("USER_RATE", "1"))    # tokens/second per user
+USER_BURST = float(os.getenv("USER_BURST", "5"))
+CHAT_RATE = float(os.getenv("CHAT_RATE", "10"))   # tokens/second per group chat
+CHAT_BURST = float(os.getenv("CHAT_BURST", "30"))
+# Inline queries har keystroke par aati hain ("@bot emilia" = ~6 queries), isliye unka alag, bada bucket.
+# Throttled inline query ka answer nahi jaata aur gallery purane results dikhati hai, toh burst itna rakho
+# ki normal typing kabhi limit tak na pahunche; sirf lagataar spam hi rukega.
+INLINE_RATE = float(os.getenv("INLINE_RATE", "4"))
+INLINE_BURST = float(os.getenv("INLINE_BURST", "20"))
+BUCKET_IDLE_SECONDS = int(os.getenv("BUCKET_IDLE_SECONDS", "300"))
+user_buckets = {}
+chat_buckets = {}
+inline_buckets = {}
+admission_metrics = {'admitted': 0, 'throttled_user': 0, 'throttled_chat': 0, 'throttled_inline': 0, 'evicted': 0, 'last_sweep': 0.0}
+spawn_metrics = {'enqueued': 0, 'completed': 0, 'failed': 0, 'deduped': 0, 'dropped': 0, 'delayed': 0,
+                 'wait_total': 0.0, 'run_total': 0.0, 'run_max': 0.0}
 
 # Logging setup
 logging.basicConfig(
@@ -71,7 +131,8 @@ def initialize_database():
         "CREATE TABLE IF NOT EXISTS characters (char_id SERIAL PRIMARY KEY, name TEXT UNIQUE NOT NULL, image_url TEXT, rarity TEXT DEFAULT 'Common', anime TEXT DEFAULT 'Unknown');", 
         "CREATE TABLE IF NOT EXISTS user_collection (user_id BIGINT REFERENCES users(user_id), char_id INT REFERENCES characters(char_id), grab_time TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (user_id, char_id));",
         "CREATE TABLE IF NOT EXISTS user_profiles (user_id BIGINT PRIMARY KEY REFERENCES users(user_id), trades_done INT DEFAULT 0, gifts_sent INT DEFAULT 0, gifts_received INT DEFAULT 0, hmode_text TEXT DEFAULT 'Harem Collection', imode_text TEXT DEFAULT 'Inline Waifus');",
-        "CREATE TABLE IF NOT EXISTS pending_trades (trade_id TEXT PRIMARY KEY, from_user_id BIGINT REFERENCES users(user_id), to_user_id BIGINT REFERENCES users(user_id), from_char_name TEXT NOT NULL, to_char_name TEXT NOT NULL, status TEXT DEFAULT 'PENDING', created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);",
+        "CREATE TABLE IF NOT EXISTS chat_user_grabs (chat_id BIGINT NOT NULL, user_id BIGINT REFERENCES users(user_id), grabs INT DEFAULT 0, PRIMARY KEY (chat_id, user_id));",
+        "CREATE TABLE IF NOT EXISTS pending_trades (trade_id TEXT PRIMARY KEY, from_user_id BIGINT REFERENCES users(user_id), to_user_id BIGINT REFERENCES users(user_id), from_char_name TEXT NOT NULL, to_char_name TEXT NOT NULL, from_char_ids INT[], to_char_ids INT[], status TEXT DEFAULT 'PENDING', created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);",
         
         # --- MIGRATION: ADD MISSING COLUMNS (Data safety ke liye zaroori) ---
         "ALTER TABLE user_profiles ADD COLUMN IF NOT EXISTS hmode_text TEXT DEFAULT 'Harem Collection';",
@@ -79,6 +140,19 @@ def initialize_database():
         "ALTER TABLE characters ADD COLUMN IF NOT EXISTS image_url TEXT;",
         "ALTER TABLE characters ADD COLUMN IF NOT EXISTS rarity TEXT DEFAULT 'Common';",
         "ALTER TABLE characters ADD COLUMN IF NOT EXISTS anime TEXT DEFAULT 'Unknown';",
+        "ALTER TABLE characters ADD COLUMN IF NOT EXISTS thumbnail_url TEXT;",
+        "ALTER TABLE user_collection ADD COLUMN IF NOT EXISTS chat_id BIGINT;",
+        "ALTER TABLE pending_trades ADD COLUMN IF NOT EXISTS from_char_ids INT[];",
+        "ALTER TABLE pending_trades ADD COLUMN IF NOT EXISTS to_char_ids INT[];",
+        "ALTER TABLE characters ADD COLUMN IF NOT EXISTS image_key TEXT;",
+        "ALTER TABLE characters ADD COLUMN IF NOT EXISTS content_hash TEXT;",
+        "ALTER TABLE characters ADD COLUMN IF NOT EXISTS phash BIGINT;",
+        
+        # --- INDEXES (image identity se dedupe lookups) ---
+        "CREATE INDEX IF NOT EXISTS idx_characters_image_key ON characters (image_key);",
+        "CREATE INDEX IF NOT EXISTS idx_characters_content_hash ON characters (content_hash);",
+        "CREATE INDEX IF NOT EXISTS idx_characters_phash ON characters (phash);",
+        "CREATE INDEX IF NOT EXISTS idx_chat_user_grabs_rank ON chat_user_grabs (chat_id, grabs DESC);",
     ]
     
     conn = None
@@ -121,11 +195,164 @@ def register_user(user):
         (user.id,)
     )
 
+# --- IMAGE IDENTITY (DEDUPLICATION) ---
+
+SYNTHETIC_NAME_PREFIX = "Waifu #"
+DEDUPE_BATCH_SIZE = 500
+
+def normalize_image_url(image_url):
+    """URL ko canonical form mein laata hai (scheme/host lowercase, query/fragment hata ke)."""
+    parts = urlsplit(image_url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), '', ''))
+
+def perceptual_hash(content):
+    """64-bit dHash (signed BIGINT mein fit hone ke liye). Pillow na ho toh None."""
+    if Image is None:
+        return None
+    with Image.open(BytesIO(content)) as img:
+        pixels = list(img.convert("L").resize((9, 8)).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def resolve_image_identity(image_url):
+    """
+    Image ki identity nikalta hai: (image_key, content_hash, phash, content, existing_name).
+    Pehle sasta URL lookup, phir content hash, phir perceptual hash.
+    Downloaded content return hota hai taaki thumbnail ke liye dobara fetch na karna pade.
+    """
+    image_key = normalize_image_url(image_url)
+    existing = execute_query("SELECT name FROM characters WHERE image_key = %s ORDER BY char_id LIMIT 1;", (image_key,), fetch=True)
+    if existing:
+        return image_key, None, None, None, existing[0][0]
+
+    try:
+        response = requests.get(image_url, timeout=15)
+        response.raise_for_status()
+        content = response.content
+    except Exception as e:
+        logger.warning(f"Image download failed for {image_url}: {e}")
+        return image_key, None, None, None, None
+
+    content_hash = hashlib.sha256(content).hexdigest()
+    try:
+        phash = perceptual_hash(content)
+    except Exception as e:
+        logger.warning(f"Perceptual hash failed for {image_url}: {e}")
+        phash = None
+
+    existing = execute_query("SELECT name FROM characters WHERE content_hash = %s ORDER BY char_id LIMIT 1;", (content_hash,), fetch=True)
+    if not existing and phash is not None:
+        # Perceptual match sirf synthetic rows se, taaki near-match kisi curated (tagged) character ko na pakde
+        existing = execute_query(
+            "SELECT name FROM characters WHERE phash = %s AND name LIKE %s ORDER BY char_id LIMIT 1;",
+            (phash, f"{SYNTHETIC_NAME_PREFIX}%"), fetch=True
+        )
+    return image_key, content_hash, phash, content, existing[0][0] if existing else None
+
+def synthetic_waifu_name(image_key, content_hash):
+    """Bina character tag wali image ka stable naam (same image = same naam)."""
+    digest = content_hash or hashlib.sha256(image_key.encode()).hexdigest()
+    return f"{SYNTHETIC_NAME_PREFIX}{digest[:16]}" # 64 bits; UNIQUE(name) par alag images takraayein nahi
+
+def backfill_image_keys():
+    """Purane characters rows mein image_key bharta hai (batches mein)."""
+    total = 0
+    while True:
+        rows = execute_query(
+            "SELECT char_id, image_url FROM characters WHERE image_key IS NULL AND image_url IS NOT NULL LIMIT %s;",
+            (DEDUPE_BATCH_SIZE,), fetch=True
+        )
+        if not rows:
+            return total
+        execute_query(
+            "UPDATE characters c SET image_key = m.image_key FROM unnest(%s::int[], %s::text[]) AS m(char_id, image_key) WHERE c.char_id = m.char_id;",
+            ([r[0] for r in rows], [normalize_image_url(r[1]) for r in rows])
+        )
+        total += len(rows)
+
+def merge_duplicate_characters(key_column):
+    """
+    Same image identity wale characters ko ek row mein merge karta hai.
+    Asli (tagged) naam wali row rakhi jaati hai, user_collection rows usi par repoint hoti hain.
+    """
+    if key_column not in ("image_key", "content_hash"):
+        raise ValueError(f"Invalid dedupe key: {key_column}")
+
+    merged = 0
+    while True:
+        pairs = execute_query(
+            f"""
+            SELECT char_id, keep_id FROM (
+                SELECT char_id, FIRST_VALUE(char_id) OVER (
+                    PARTITION BY {key_column}
+                    ORDER BY (name LIKE %s), char_id
+                ) AS keep_id
+                FROM characters WHERE {key_column} IS NOT NULL
+            ) d WHERE char_id <> keep_id LIMIT %s;
+            """,
+            (f"{SYNTHETIC_NAME_PREFIX}%", DEDUPE_BATCH_SIZE), fetch=True
+        )
+        if not pairs:
+            return merged
+
+        dup_ids = [p[0] for p in pairs]
+        keep_ids = [p[1] for p in pairs]
+        # Ek hi transaction: pehle keeper par copy, merged chars wale PENDING trades cancel, phir duplicates hatao
+        result = execute_query(
+            """
+            INSERT INTO user_collection (user_id, char_id, grab_time, chat_id)
+            SELECT uc.user_id, m.keep_id, uc.grab_time, uc.chat_id
+            FROM user_collection uc JOIN unnest(%s::int[], %s::int[]) AS m(dup_id, keep_id) ON uc.char_id = m.dup_id
+            ON CONFLICT DO NOTHING;
+            UPDATE pending_trades SET status = 'CANCELLED'
+            WHERE status = 'PENDING' AND (
+                from_char_ids && %s::int[] OR to_char_ids && %s::int[]
+                OR (from_char_ids IS NULL AND (from_char_name IN (SELECT name FROM characters WHERE char_id = ANY(%s))
+                                               OR to_char_name IN (SELECT name FROM characters WHERE char_id = ANY(%s))))
+            );
+            DELETE FROM user_collection WHERE char_id = ANY(%s);
+            DELETE FROM characters WHERE char_id = ANY(%s) RETURNING char_id;
+            """,
+            (dup_ids, keep_ids, dup_ids, dup_ids, dup_ids, dup_ids, dup_ids, dup_ids), fetch=True
+        )
+        if not result:
+            logger.error("Dedupe batch failed, stopping merge.")
+            return merged
+        merged += len(result)
+
+def dedupe_characters():
+    """Poora maintenance pass: image_key backfill, phir URL aur content hash se merge."""
+    backfilled = backfill_image_keys()
+    merged = merge_duplicate_characters("image_key") + merge_duplicate_characters("content_hash")
+    return backfilled, merged
+
+def record_grab(user_id, char_id, chat_id):
+    """Grab ko collection mein daalta hai aur usi statement mein group ka (chat, user) counter badhata hai."""
+    execute_query(
+        """
+        WITH grabbed AS (
+            INSERT INTO user_collection (user_id, char_id, chat_id) VALUES (%s, %s, %s)
+            ON CONFLICT DO NOTHING RETURNING user_id, chat_id
+        )
+        INSERT INTO chat_user_grabs (chat_id, user_id, grabs)
+        SELECT chat_id, user_id, 1 FROM grabbed
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET grabs = chat_user_grabs.grabs + 1;
+        """,
+        (user_id, char_id, chat_id)
+    )
+
 async def get_random_waifu():
+    """fetch_random_waifu ko thread mein chalata hai taaki event loop block na ho."""
+    return await asyncio.to_thread(fetch_random_waifu)
+
+def fetch_random_waifu():
     """Waifu.im se random waifu fetch karta hai aur uski details nikalta hai."""
     try:
         # SFW Waifu images ko target karna
-        response = requests.get("https://api.waifu.im/search?is_nsfw=false&tags=waifu")
+        response = requests.get("https://api.waifu.im/search?is_nsfw=false&tags=waifu", timeout=15)
         response.raise_for_status()
         data = response.json()
         
@@ -145,48 +372,437 @@ async def get_random_waifu():
                       anime_name = tag['name'] 
         
         if character_name == "Unknown Waifu":
-             # Agar naam nahi mila toh timestamp se unique naam banao
-             character_name = f"Waifu #{str(uuid.uuid4())[:8]}" 
+             # Agar naam nahi mila toh pehle dekhi hui image ka naam, warna hash se stable naam
+             image_key, content_hash, phash, content, existing_name = resolve_image_identity(image_url)
+             character_name = existing_name or synthetic_waifu_name(image_key, content_hash)
+             matched = existing_name is not None
+        else:
+             # Tagged naam pehle se stable hai, download/hash ki zaroorat nahi
+             image_key, content_hash, phash, content = normalize_image_url(image_url), None, None, None
+             matched = False
              
         # Simple Rarity Logic (Can be improved)
         rarity = random.choice(["Common", "Rare", "Epic", "Legendary"])
 
-        return character_name.strip(), image_url, rarity, anime_name.strip()
+        return character_name.strip(), image_url, rarity, anime_name.strip(), (image_key, content_hash, phash, content, matched)
     except Exception as e:
         logger.error(f"API Error fetching waifu: {e}")
-        return None, None, None, None
+        return None, None, None, None, None
+
+# --- THUMBNAIL PIPELINE ---
+
+def thumbnail_public_url(filename):
+    """Cache file ka public URL (webhook server par served)."""
+    return f"{WEBHOOK_URL}/{THUMB_URL_PATH}/{filename}"
+
+def scan_thumbnail_cache():
+    """Cache files ki (mtime, size, path, name) list. Adhoori .tmp files aur beech mein hati files skip hoti hain."""
+    entries = []
+    try:
+        with os.scandir(THUMB_DIR) as it:
+            for entry in it:
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue # Kisi aur thread ne abhi hata di
+                entries.append((st.st_mtime, st.st_size, entry.path, entry.name))
+    except FileNotFoundError:
+        pass
+    return entries
+
+def add_to_thumbnail_cache(size):
+    """
+    Naye thumbnail ka size running total mein jodta hai. Total limit se upar jaaye tabhi
+    directory scan karke sabse purane thumbnails hatata hai. Hataye gaye filenames return karta hai.
+    """
+    global thumb_cache_bytes
+    with thumb_cache_lock:
+        if thumb_cache_bytes is None:
+            thumb_cache_bytes = sum(e[1] for e in scan_thumbnail_cache())
+        else:
+            thumb_cache_bytes += size
+        if thumb_cache_bytes <= THUMB_CACHE_MAX_BYTES:
+            return []
+
+        entries = scan_thumbnail_cache()
+        total = sum(e[1] for e in entries)
+        removed = []
+        for _, entry_size, path, name in sorted(entries):
+            if total <= THUMB_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                total -= entry_size
+                removed.append(name)
+            except FileNotFoundError:
+                total -= entry_size
+            except OSError as e:
+                logger.warning(f"Thumbnail evict failed for {name}: {e}")
+        thumb_cache_bytes = total
+        return removed
+
+def build_thumbnail(image_url, content=None):
+    """
+    Image se chhota thumbnail banata hai (content na mile toh ek baar download karta hai).
+    File ka naam content hash hota hai, toh same image dobara encode nahi hoti.
+    Return: (filename, evicted_filenames)
+    """
+    if content is None:
+        response = requests.get(image_url, timeout=15)
+        response.raise_for_status()
+        content = response.content
+
+    ext = "webp" if THUMB_FORMAT == "WEBP" else "jpg"
+    filename = f"{hashlib.sha256(content).hexdigest()}.{ext}"
+    path = os.path.join(THUMB_DIR, filename)
+
+    if os.path.exists(path):
+        try:
+            os.utime(path) # LRU eviction ke liye "recently used" mark karo
+            return filename, []
+        except FileNotFoundError:
+            pass # Abhi evict hui, dobara banao
+
+    with Image.open(BytesIO(content)) as img:
+        img = img.convert("RGB")
+        img.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        os.makedirs(THUMB_DIR, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, THUMB_FORMAT, quality=80)
+        os.replace(tmp_path, path) # Adhoori file kabhi serve na ho
+
+    return filename, add_to_thumbnail_cache(os.path.getsize(path))
+
+def generate_thumbnail(image_url, content=None):
+    """(Worker thread mein chalta hai) Thumbnail banata hai aur characters table update karta hai."""
+    filename, evicted = build_thumbnail(image_url, content)
+    if evicted:
+        # Evicted thumbnails ko NULL karo taaki agli search mein dobara ban jayein
+        execute_query(
+            "UPDATE characters SET thumbnail_url = NULL WHERE thumbnail_url = ANY(%s);",
+            ([thumbnail_public_url(f) for f in evicted],)
+        )
+    execute_query(
+        "UPDATE characters SET thumbnail_url = %s WHERE image_url = %s;",
+        (thumbnail_public_url(filename), image_url)
+    )
+
+def thumbnail_recently_failed(image_url, now):
+    """Negative cache: haal hi mein fail hui image ko dobara download nahi karte."""
+    retry_after = thumb_failures.get(image_url)
+    if retry_after is None:
+        return False
+    if now < retry_after:
+        return True
+    del thumb_failures[image_url]
+    return False
+
+async def ensure_thumbnail(image_url, content=None):
+    """
+    Character image ka thumbnail worker pool mein banwata hai (DB update bhi wahi hota hai).
+    Spawn ke waqt download hui image ka content mile toh wahi use hota hai.
+    """
+    if Image is None or not WEBHOOK_URL or not image_url or image_url in thumbs_in_flight:
+        return
+    now = time.monotonic()
+    if thumbnail_recently_failed(image_url, now):
+        return
+
+    thumbs_in_flight.add(image_url)
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(thumb_executor, generate_thumbnail, image_url, content)
+    except Exception as e:
+        logger.warning(f"Thumbnail generation failed for {image_url}: {e}")
+        if len(thumb_failures) > 10000:
+            # Expired entries saaf karo taaki negative cache bhi bounded rahe
+            for url in [u for u, t in thumb_failures.items() if t <= now]:
+                del thumb_failures[url]
+        thumb_failures[image_url] = now + THUMB_FAILURE_TTL
+    finally:
+        thumbs_in_flight.discard(image_url)
+
+# --- SPAWN REGISTRY ---
+
+class SpawnRecord:
+    """Ek chat ka active (unclaimed) spawn. Rarity/anime interned hain kyunki bahut repeat hote hain."""
+    __slots__ = ('name', 'image', 'rarity', 'anime', 'message_id', 'spawned_at')
+
+    def __init__(self, name, image, rarity, anime, message_id, spawned_at):
+        self.name = name
+        self.image = image
+        self.rarity = sys.intern(rarity)
+        self.anime = sys.intern(anime)
+        self.message_id = message_id
+        self.spawned_at = spawned_at
+
+    def is_expired(self, now):
+        return now - self.spawned_at > SPAWN_TTL_SECONDS
+
+def get_active_spawn(chat_id):
+    """Chat ka unclaimed, non-expired spawn (ya None)."""
+    record = current_spawns.get(chat_id)
+    if record is None or record.is_expired(time.monotonic()):
+        return None
+    return record
+
+def claim_spawn(chat_id, record):
+    """Spawn ko registry se turant hatata hai. False = kisi aur ne pehle claim/expire kar diya."""
+    if current_spawns.get(chat_id) is not record:
+        return False
+    del current_spawns[chat_id]
+    spawn_registry_metrics['claimed'] += 1
+    return True
+
+async def expire_spawn(bot, chat_id, record):
+    """Expired spawn hatata hai aur purane message ko 'bhaag gayi' dikhane ke liye edit karta hai."""
+    if current_spawns.get(chat_id) is not record:
+        return
+    del current_spawns[chat_id]
+    spawn_registry_metrics['expired'] += 1
+    try:
+        await bot.edit_message_caption(
+            chat_id=chat_id,
+            message_id=record.message_id,
+            caption=f"💨 **{record.name}** ({record.rarity}) bhaag gayi! Kisi ne time par grab nahi kiya.",
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=None
+        )
+    except Exception as e:
+        logger.debug(f"Escaped spawn edit failed for chat {chat_id}: {e}")
+
+async def spawn_expiry_sweeper(bot):
+    """Har SPAWN_SWEEP_INTERVAL seconds mein expired spawns saaf karta hai."""
+    while True:
+        await asyncio.sleep(SPAWN_SWEEP_INTERVAL)
+        now = time.monotonic()
+        expired = [(chat_id, record) for chat_id, record in current_spawns.items() if record.is_expired(now)]
+        for chat_id, record in expired:
+            await expire_spawn(bot, chat_id, record)
+
+def format_spawn_registry_metrics():
+    """Spawn registry ke stats text mein."""
+    return (
+        f"📍 **Spawn Registry** (TTL: {SPAWN_TTL_SECONDS}s)\n"
+        f"  • Active: {len(current_spawns)}\n"
+        f"  • Spawned: {spawn_registry_metrics['spawned']} | Claimed: {spawn_registry_metrics['claimed']} | Escaped: {spawn_registry_metrics['expired']}"
+    )
 
 # --- CORE LOGIC (SPAWN AND COUNTER) ---
 
 async def spawn_waifu(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     """Chat mein ek nayi waifu spawn karta hai."""
-    global current_spawns
-    
     # Check if a waifu is already spawned and unclaimed in this chat
-    if chat_id in current_spawns and not current_spawns[chat_id].get('claimed', True):
+    if get_active_spawn(chat_id):
         return
+    previous = current_spawns.get(chat_id)
+    if previous:
+        await expire_spawn(context.bot, chat_id, previous) # Sweeper se pehle hi expire ho chuki thi
 
-    name, image, rarity, anime = await get_random_waifu()
+    name, image, rarity, anime, identity = await get_random_waifu()
     
     if name and image:
-        current_spawns[chat_id] = {'name': name, 'image': image, 'claimed': False, 'rarity': rarity, 'anime': anime}
-        
         keyboard = [[InlineKeyboardButton("💖 GRAB 💖", callback_data="grab_waifu")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         # Waifu details ko DB mein save karein (ya update karein)
-        execute_query(
-            "INSERT INTO characters (name, image_url, rarity, anime) VALUES (%s, %s, %s, %s) ON CONFLICT (name) DO UPDATE SET image_url = EXCLUDED.image_url, rarity = EXCLUDED.rarity, anime = EXCLUDED.anime;",
-            (name, image, rarity, anime)
+        image_key, content_hash, phash, content, matched = identity
+        if matched:
+            # Naam identity match se mila: existing row ka image/anime curated hai, sirf rarity badlo
+            upsert_query = (
+                "INSERT INTO characters (name, image_url, rarity, anime, image_key, content_hash, phash) VALUES (%s, %s, %s, %s, %s, %s, %s) "
+                "ON CONFLICT (name) DO UPDATE SET rarity = EXCLUDED.rarity, "
+                "content_hash = COALESCE(characters.content_hash, EXCLUDED.content_hash), phash = COALESCE(characters.phash, EXCLUDED.phash) "
+                "RETURNING thumbnail_url, image_url, anime;"
+            )
+        else:
+            # Image badli ho toh purana thumbnail NULL; warna existing thumbnail reuse (dobara download nahi)
+            upsert_query = (
+                "INSERT INTO characters (name, image_url, rarity, anime, image_key, content_hash, phash) VALUES (%s, %s, %s, %s, %s, %s, %s) "
+                "ON CONFLICT (name) DO UPDATE SET image_url = EXCLUDED.image_url, rarity = EXCLUDED.rarity, anime = EXCLUDED.anime, "
+                "image_key = EXCLUDED.image_key, content_hash = COALESCE(EXCLUDED.content_hash, characters.content_hash), phash = COALESCE(EXCLUDED.phash, characters.phash), "
+                "thumbnail_url = CASE WHEN characters.image_url = EXCLUDED.image_url THEN characters.thumbnail_url END "
+                "RETURNING thumbnail_url, image_url, anime;"
+            )
+        saved = await asyncio.to_thread(
+            execute_query, upsert_query,
+            (name, image, rarity, anime, image_key, content_hash, phash),
+            fetch=True
         )
-
-        await context.bot.send_photo(
+        thumbnail_url = None
+        if saved:
+            # Spawn (aur baad ka grab upsert) wahi image/anime use kare jo DB mein hai
+            thumbnail_url, image, anime = saved[0]
+        if not thumbnail_url:
+            context.application.create_task(ensure_thumbnail(image, content))
+
+        message = await context.bot.send_photo(
             chat_id=chat_id,
             photo=image,
             caption=f"✨ Ek wild **{name}** ({rarity}) prakat hui hai! ✨\n\n**Anime:** {anime}\n\nUse apna banane ke liye 'GRAB' button dabayein!",
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=reply_markup
         )
+        current_spawns[chat_id] = SpawnRecord(name, image, rarity, anime, message.message_id, time.monotonic())
+        spawn_registry_metrics['spawned'] += 1
+
+# --- SPAWN WORKER POOL ---
+
+def enqueue_spawn(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """
+    Spawn ko worker pool ki queue mein daalta hai. True = accepted (ya pehle se pending).
+    False = queue full aur policy 'delay' hai, caller counter reset na kare taaki agle message par retry ho.
+    """
+    if chat_id in pending_spawn_chats:
+        spawn_metrics['deduped'] += 1
+        return True
+
+    try:
+        spawn_queue.put_nowait((chat_id, context, time.monotonic()))
+    except asyncio.QueueFull:
+        if SPAWN_OVERLOAD_POLICY == "drop":
+            spawn_metrics['dropped'] += 1
+            logger.warning(f"Spawn queue full, dropping spawn for chat {chat_id}.")
+            return True
+        spawn_metrics['delayed'] += 1
+        return False
+
+    pending_spawn_chats.add(chat_id)
+    spawn_metrics['enqueued'] += 1
+    return True
+
+async def spawn_worker(worker_id: int):
+    """Queue se spawns uthata hai; SPAWN_WORKERS workers = max concurrent spawns."""
+    while True:
+        chat_id, context, enqueued_at = await spawn_queue.get()
+        started_at = time.monotonic()
+        spawn_metrics['wait_total'] += started_at - enqueued_at
+        try:
+            await asyncio.wait_for(spawn_waifu(context, chat_id), timeout=SPAWN_TIMEOUT_SECONDS)
+            spawn_metrics['completed'] += 1
+        except asyncio.TimeoutError:
+            spawn_metrics['failed'] += 1
+            logger.error(f"Spawn worker {worker_id} timed out for chat {chat_id} after {SPAWN_TIMEOUT_SECONDS}s.")
+        except Exception as e:
+            spawn_metrics['failed'] += 1
+            logger.error(f"Spawn worker {worker_id} failed for chat {chat_id}: {e}")
+        finally:
+            run_time = time.monotonic() - started_at
+            spawn_metrics['run_total'] += run_time
+            spawn_metrics['run_max'] = max(spawn_metrics['run_max'], run_time)
+            pending_spawn_chats.discard(chat_id)
+            spawn_queue.task_done()
+
+def start_spawn_workers(application):
+    """Spawn queue, worker tasks aur expiry sweeper banata hai (event loop ke andar call karein)."""
+    global spawn_queue
+    spawn_queue = asyncio.Queue(maxsize=SPAWN_QUEUE_SIZE)
+    for worker_id in range(SPAWN_WORKERS):
+        spawn_worker_tasks.append(application.create_task(spawn_worker(worker_id)))
+    spawn_worker_tasks.append(application.create_task(spawn_expiry_sweeper(application.bot)))
+
+async def stop_spawn_workers():
+    """Worker tasks cancel karta hai."""
+    for task in spawn_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*spawn_worker_tasks, return_exceptions=True)
+    spawn_worker_tasks.clear()
+
+def format_spawn_metrics():
+    """Spawn pool ke stats text mein."""
+    finished = spawn_metrics['completed'] + spawn_metrics['failed']
+    avg_wait = spawn_metrics['wait_total'] / finished if finished else 0.0
+    avg_run = spawn_metrics['run_total'] / finished if finished else 0.0
+    return (
+        f"🌀 **Spawn Pool** ({SPAWN_WORKERS} workers, policy: {SPAWN_OVERLOAD_POLICY})\n"
+        f"  • Queue depth: {spawn_queue.qsize() if spawn_queue else 0}/{SPAWN_QUEUE_SIZE}\n"
+        f"  • Pending chats: {len(pending_spawn_chats)}\n"
+        f"  • Enqueued: {spawn_metrics['enqueued']} | Completed: {spawn_metrics['completed']} | Failed: {spawn_metrics['failed']}\n"
+        f"  • Deduped: {spawn_metrics['deduped']} | Dropped: {spawn_metrics['dropped']} | Delayed: {spawn_metrics['delayed']}\n"
+        f"  • Avg wait: {avg_wait:.2f}s | Avg run: {avg_run:.2f}s | Max run: {spawn_metrics['run_max']:.2f}s"
+    )
+
+# --- ADMISSION CONTROL (LOAD SHEDDING) ---
+
+class TokenBucket:
+    """Compact token bucket state (sirf do floats)."""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+def take_token(buckets, key, rate, burst, now):
+    """Bucket se ek token leta hai. False = limit cross ho gayi."""
+    bucket = buckets.get(key)
+    if bucket is None:
+        buckets[key] = TokenBucket(burst - 1, now)
+        return True
+
+    bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+    bucket.updated = now
+    if bucket.tokens < 1:
+        return False
+    bucket.tokens -= 1
+    return True
+
+def evict_idle_buckets(now):
+    """Idle buckets hatata hai; itni der mein woh waise bhi full refill ho chuke hote."""
+    for buckets, rate, burst in ((user_buckets, USER_RATE, USER_BURST), (chat_buckets, CHAT_RATE, CHAT_BURST),
+                                 (inline_buckets, INLINE_RATE, INLINE_BURST)):
+        idle_after = max(BUCKET_IDLE_SECONDS, burst / rate)
+        stale = [key for key, bucket in buckets.items() if now - bucket.updated > idle_after]
+        for key in stale:
+            del buckets[key]
+        admission_metrics['evicted'] += len(stale)
+    admission_metrics['last_sweep'] = now
+
+async def admission_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    (group -1) Har update par sabse pehle chalta hai. Flood karne wale user/chat ke updates
+    yahin rok diye jaate hain, taaki register_user, spawn counter ya DB queries tak na pahunchein.
+    """
+    user = update.effective_user
+    if user is None or user.id in ADMIN_USER_IDS:
+        return
+
+    now = time.monotonic()
+    if now - admission_metrics['last_sweep'] > BUCKET_IDLE_SECONDS:
+        evict_idle_buckets(now)
+
+    chat = update.effective_chat
+    throttled = None
+    if update.inline_query:
+        # Inline search ka apna bucket (upar INLINE_RATE dekhein), user bucket se alag
+        if not take_token(inline_buckets, user.id, INLINE_RATE, INLINE_BURST, now):
+            throttled = 'throttled_inline'
+    elif not take_token(user_buckets, user.id, USER_RATE, USER_BURST, now):
+        throttled = 'throttled_user'
+    elif chat and chat.type != "private" and not take_token(chat_buckets, chat.id, CHAT_RATE, CHAT_BURST, now):
+        throttled = 'throttled_chat'
+
+    if throttled is None:
+        admission_metrics['admitted'] += 1
+        return
+
+    admission_metrics[throttled] += 1
+    if update.callback_query:
+        try:
+            await update.callback_query.answer("Thoda dheere! 🐢")
+        except Exception:
+            pass
+    raise ApplicationHandlerStop
+
+def format_admission_metrics():
+    """Admission layer ke stats text mein."""
+    return (
+        f"🚦 **Admission Control**\n"
+        f"  • Admitted: {admission_metrics['admitted']}\n"
+        f"  • Throttled (user): {admission_metrics['throttled_user']} | Throttled (chat): {admission_metrics['throttled_chat']} | Throttled (inline): {admission_metrics['throttled_inline']}\n"
+        f"  • Buckets: {len(user_buckets)} users, {len(chat_buckets)} chats, {len(inline_buckets)} inline | Evicted: {admission_metrics['evicted']}"
+    )
 
 # --- COMMAND HANDLERS ---
 
@@ -205,6 +821,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"\n/harem - Apni {hmode_text} dekhein."
         f"\n/status - Apne Harem Stats dekhein."
         f"\n/trade & /gift - Waifus ka aadaan-pradaan karein."
+        f"\n/ctop - Is group ka leaderboard dekhein."
         f"\n\n**Gallery Search:**"
         f"\nKisi bhi chat mein type karein: <b>@botname [waifu name]</b> - Gallery mein search karne ke liye!"
     )
@@ -215,7 +832,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "**FAQ/Madad:**\n"
         "1. **Spawn:** Har {SPAWN_THRESHOLD} messages ke baad ek waifu spawn hogi. Use /grab ya button se claim karein.\n"
         "2. **Collection:** /harem se aapki collection dekhein.\n"
-        "3. **Trade/Gift:** /trade @user [Aapka Char] for [Unka Char] or /gift @user [Char Name].\n"
+        "3. **Trade/Gift:** /trade @user [Char1, Char2] for [Char3, Char4] or /gift @user [Char1, Char2].\n"
         "4. **Search:** Chat mein **@botname [waifu name]** type karein gallery search ke liye."
         , parse_mode=ParseMode.MARKDOWN
     )
@@ -225,36 +842,37 @@ async def grab_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
-    if chat_id not in current_spawns or current_spawns[chat_id].get('claimed', True):
+    spawned_waifu = get_active_spawn(chat_id)
+    if spawned_waifu is None:
         await update.message.reply_text("Abhi koi waifu spawned nahi hai. Agli spawn ka intezaar karein!")
         return
-
-    spawned_waifu = current_spawns[chat_id]
     
     # Check if user already has the character
     check_query = """SELECT c.name FROM user_collection uc JOIN characters c ON uc.char_id = c.char_id WHERE uc.user_id = %s AND c.name = %s;"""
-    if execute_query(check_query, (user_id, spawned_waifu['name']), fetch=True):
-         await update.message.reply_text(f"**{update.effective_user.first_name}** ke paas **{spawned_waifu['name']}** pehle se hai!", parse_mode=ParseMode.MARKDOWN)
+    if execute_query(check_query, (user_id, spawned_waifu.name), fetch=True):
+         await update.message.reply_text(f"**{update.effective_user.first_name}** ke paas **{spawned_waifu.name}** pehle se hai!", parse_mode=ParseMode.MARKDOWN)
          return
 
     # Claim the character
     execute_query(
         "INSERT INTO characters (name, image_url, rarity, anime) VALUES (%s, %s, %s, %s) ON CONFLICT (name) DO UPDATE SET image_url = EXCLUDED.image_url, rarity = EXCLUDED.rarity, anime = EXCLUDED.anime;",
-        (spawned_waifu['name'], spawned_waifu['image'], spawned_waifu['rarity'], spawned_waifu['anime'])
+        (spawned_waifu.name, spawned_waifu.image, spawned_waifu.rarity, spawned_waifu.anime)
     )
     
-    char_id_result = execute_query("SELECT char_id FROM characters WHERE name = %s;", (spawned_waifu['name'],), fetch=True)
+    char_id_result = execute_query("SELECT char_id FROM characters WHERE name = %s;", (spawned_waifu.name,), fetch=True)
     if char_id_result:
         char_id = char_id_result[0][0]
-        execute_query("INSERT INTO user_collection (user_id, char_id) VALUES (%s, %s);", (user_id, char_id))
-        current_spawns[chat_id]['claimed'] = True
+        if not claim_spawn(chat_id, spawned_waifu):
+            await update.message.reply_text("Bahut der kardi! 🥺")
+            return
+        record_grab(user_id, char_id, chat_id)
         
         # Edit the original message (if possible)
         try:
              await context.bot.edit_message_caption(
                  chat_id=chat_id,
-                 message_id=update.message.message_id - 1, # Thoda mushkil, agar button se na ho to ignore
-                 caption=f"✨ **{spawned_waifu['name']}** ({spawned_waifu['rarity']}) ✨\n\n💖 **Grabbed by: {update.effective_user.first_name}** 💖",
+                 message_id=spawned_waifu.message_id,
+                 caption=f"✨ **{spawned_waifu.name}** ({spawned_waifu.rarity}) ✨\n\n💖 **Grabbed by: {update.effective_user.first_name}** 💖",
                  parse_mode=ParseMode.MARKDOWN,
                  reply_markup=None
              )
@@ -262,7 +880,7 @@ async def grab_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
              pass # Agar edit fail ho toh ignore karo
              
         await update.message.reply_text(
-            f"🎉 Badhaai ho, **{update.effective_user.first_name}**! Aapne **{spawned_waifu['name']}** ko apne harem mein shaamil kar liya hai!",
+            f"🎉 Badhaai ho, **{update.effective_user.first_name}**! Aapne **{spawned_waifu.name}** ko apne harem mein shaamil kar liya hai!",
             parse_mode=ParseMode.MARKDOWN
         )
     else:
@@ -307,13 +925,38 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         , parse_mode=ParseMode.MARKDOWN
     )
 
-# Trading and Gifting functions (Same as previous response, included for completeness)
+# Trading and Gifting functions (ek command mein kai characters, set-based queries)
+MAX_BATCH_CHARS = 25 # Ek /gift ya /trade mein max characters
+
+def parse_char_names(text):
+    """'A, B, C' ko naamon ki list banata hai (case-insensitive duplicates hata ke)."""
+    names, seen = [], set()
+    for name in text.split(','):
+        name = name.strip()
+        if name and name.lower() not in seen:
+            seen.add(name.lower())
+            names.append(name)
+    return names
+
+def resolve_owned_characters(user_id, names):
+    """
+    Ek hi query mein check karta hai ki user ke paas kaunse characters hain.
+    Return: ([(char_id, name), ...], [missing names])
+    """
+    rows = execute_query(
+        "SELECT c.char_id, c.name FROM user_collection uc JOIN characters c ON uc.char_id = c.char_id WHERE uc.user_id = %s AND lower(c.name) = ANY(%s);",
+        (user_id, [n.lower() for n in names]), fetch=True
+    ) or []
+    found = {name.lower() for _, name in rows}
+    missing = [n for n in names if n.lower() not in found]
+    return rows, missing
+
 async def trade_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (Full /trade logic) ...
+    """/trade @username A, B for C, D: Kai characters ka ek saath trade."""
     try:
         args = context.args
         if len(args) < 3 or 'for' not in args:
-            await update.message.reply_text("Format galat hai. Sahi format: /trade @username [My Character] for [Their Character]")
+            await update.message.reply_text("Format galat hai. Sahi format: /trade @username [My Char1, My Char2] for [Their Char1, Their Char2]")
             return
 
         target_username_mention = args[0]
@@ -327,12 +970,18 @@ async def trade_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         full_args = " ".join(args[1:])
         if ' for ' not in full_args:
-             await update.message.reply_text("Format: /trade @username [My Character] for [Their Character]")
+             await update.message.reply_text("Format: /trade @username [My Char1, My Char2] for [Their Char1, Their Char2]")
              return
         
-        my_char_name, their_char_name = full_args.split(' for ', 1)
-        my_char_name = my_char_name.strip()
-        their_char_name = their_char_name.strip()
+        my_part, their_part = full_args.split(' for ', 1)
+        my_char_names = parse_char_names(my_part)
+        their_char_names = parse_char_names(their_part)
+        if not my_char_names or not their_char_names:
+            await update.message.reply_text("Dono taraf kam se kam ek character hona chahiye.")
+            return
+        if len(my_char_names) > MAX_BATCH_CHARS or len(their_char_names) > MAX_BATCH_CHARS:
+            await update.message.reply_text(f"Ek trade mein har taraf maximum {MAX_BATCH_CHARS} characters ho sakte hain.")
+            return
         
         target_result = execute_query("SELECT user_id, first_name FROM users WHERE username = %s;", (target_username,), fetch=True)
         if not target_result:
@@ -344,28 +993,24 @@ async def trade_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Aap khud se trade nahi kar sakte!")
             return
 
-        giver_has_char = execute_query(
-            "SELECT 1 FROM user_collection uc JOIN characters c ON uc.char_id = c.char_id WHERE uc.user_id = %s AND c.name ILIKE %s;",
-            (from_user_id, my_char_name), fetch=True
-        )
-        if not giver_has_char:
-            await update.message.reply_text(f"Aapke paas '{my_char_name}' naam ka character nahi hai.")
+        my_chars, my_missing = resolve_owned_characters(from_user_id, my_char_names)
+        if my_missing:
+            await update.message.reply_text(f"Aapke paas yeh characters nahi hain: {', '.join(my_missing)}")
             return
         
-        receiver_has_char = execute_query(
-            "SELECT 1 FROM user_collection uc JOIN characters c ON uc.char_id = c.char_id WHERE uc.user_id = %s AND c.name ILIKE %s;",
-            (target_user_id, their_char_name), fetch=True
-        )
-        if not receiver_has_char:
-            await update.message.reply_text(f"@{target_username} ke paas '{their_char_name}' nahi hai.")
+        their_chars, their_missing = resolve_owned_characters(target_user_id, their_char_names)
+        if their_missing:
+            await update.message.reply_text(f"@{target_username} ke paas yeh characters nahi hain: {', '.join(their_missing)}")
             return
         
-        # Use exact names found if multiple matches exist, but for now we assume ILIKE is sufficient
+        my_chars_text = ", ".join(name for _, name in my_chars)
+        their_chars_text = ", ".join(name for _, name in their_chars)
         
         trade_id = f"trade_{int(time.time())}_{from_user_id}" 
         execute_query(
-            "INSERT INTO pending_trades (trade_id, from_user_id, to_user_id, from_char_name, to_char_name) VALUES (%s, %s, %s, %s, %s);",
-            (trade_id, from_user_id, target_user_id, my_char_name, their_char_name)
+            "INSERT INTO pending_trades (trade_id, from_user_id, to_user_id, from_char_name, to_char_name, from_char_ids, to_char_ids) VALUES (%s, %s, %s, %s, %s, %s, %s);",
+            (trade_id, from_user_id, target_user_id, my_chars_text, their_chars_text,
+             [char_id for char_id, _ in my_chars], [char_id for char_id, _ in their_chars])
         )
         
         keyboard = [
@@ -381,7 +1026,7 @@ async def trade_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 chat_id=target_user_id,
                 text=f"<b>Trade Request!</b>\n\n"
                      f"{from_user_name} (@{update.effective_user.username}) "
-                     f"aapko apna '<b>{my_char_name}</b>' dekar aapse aapka '<b>{their_char_name}</b>' lena chahte hain."
+                     f"aapko apne '<b>{my_chars_text}</b>' dekar aapse aapke '<b>{their_chars_text}</b>' lena chahte hain."
                      f"\n\nKya aapko yeh trade manzoor hai?",
                 parse_mode=ParseMode.HTML,
                 reply_markup=reply_markup
@@ -397,11 +1042,11 @@ async def trade_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Trade request mein kuch gadbad hui.")
 
 async def gift_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (Full /gift logic) ...
+    """/gift @username A, B, C: Ek ya kai characters ek saath gift karta hai."""
     try:
         args = context.args
         if len(args) < 2:
-            await update.message.reply_text("Format galat hai. Sahi format: /gift @username [Character Name]")
+            await update.message.reply_text("Format galat hai. Sahi format: /gift @username [Char1, Char2, ...]")
             return
 
         target_username_mention = args[0]
@@ -412,7 +1057,13 @@ async def gift_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_username = target_username_mention[1:]
         gifter_user_id = update.effective_user.id
         gifter_user_name = update.effective_user.first_name
-        character_name = " ".join(args[1:])
+        character_names = parse_char_names(" ".join(args[1:]))
+        if not character_names:
+            await update.message.reply_text("Kam se kam ek character ka naam dein.")
+            return
+        if len(character_names) > MAX_BATCH_CHARS:
+            await update.message.reply_text(f"Ek baar mein maximum {MAX_BATCH_CHARS} characters gift ho sakte hain.")
+            return
 
         target_result = execute_query("SELECT user_id, first_name FROM users WHERE username = %s;", (target_username,), fetch=True)
         
@@ -426,30 +1077,50 @@ async def gift_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Aap khud ko gift nahi de sakte!")
             return
 
-        char_id_result = execute_query(
-            "SELECT c.char_id FROM user_collection uc JOIN characters c ON uc.char_id = c.char_id WHERE uc.user_id = %s AND c.name ILIKE %s;",
-            (gifter_user_id, character_name), fetch=True
-        )
-        if not char_id_result:
-            await update.message.reply_text(f"Aapke paas '{character_name}' naam ka character nahi hai.")
+        owned, missing = resolve_owned_characters(gifter_user_id, character_names)
+        if not owned:
+            await update.message.reply_text(f"Aapke paas in mein se koi character nahi hai: {', '.join(missing)}")
             return
-        
-        char_id = char_id_result[0][0]
 
-        execute_query("DELETE FROM user_collection WHERE user_id = %s AND char_id = %s;", (gifter_user_id, char_id))
-        execute_query("INSERT INTO user_collection (user_id, char_id) VALUES (%s, %s);", (target_user_id, char_id))
-        
-        execute_query("UPDATE user_profiles SET gifts_sent = gifts_sent + 1 WHERE user_id = %s;", (gifter_user_id,))
-        execute_query("UPDATE user_profiles SET gifts_received = gifts_received + 1 WHERE user_id = %s;", (target_user_id,))
-        
-        await update.message.reply_text(
-            f"Success! Aapne '{character_name}' ko @{target_username} ko gift kar diya hai."
-        )
+        # Ek hi statement: collection transfer + dono profiles ke gift counters.
+        # Jo character receiver ke paas pehle se hai woh gifter ke paas hi rehta hai.
+        moved = execute_query(
+            """
+            WITH moved AS (
+                UPDATE user_collection uc SET user_id = %(to_id)s
+                WHERE uc.user_id = %(from_id)s AND uc.char_id = ANY(%(char_ids)s)
+                  AND NOT EXISTS (SELECT 1 FROM user_collection t WHERE t.user_id = %(to_id)s AND t.char_id = uc.char_id)
+                RETURNING uc.char_id
+            ), counters AS (
+                UPDATE user_profiles SET
+                    gifts_sent = gifts_sent + CASE WHEN user_id = %(from_id)s THEN (SELECT COUNT(*) FROM moved) ELSE 0 END,
+                    gifts_received = gifts_received + CASE WHEN user_id = %(to_id)s THEN (SELECT COUNT(*) FROM moved) ELSE 0 END
+                WHERE user_id IN (%(from_id)s, %(to_id)s) AND EXISTS (SELECT 1 FROM moved)
+            )
+            SELECT c.name FROM moved JOIN characters c ON c.char_id = moved.char_id;
+            """,
+            {'from_id': gifter_user_id, 'to_id': target_user_id, 'char_ids': [char_id for char_id, _ in owned]},
+            fetch=True
+        ) or []
+        moved_names = [row[0] for row in moved]
+        skipped = [name for _, name in owned if name not in moved_names]
+
+        if not moved_names:
+            await update.message.reply_text(f"Gift nahi hua. @{target_username} ke paas yeh characters pehle se hain.")
+            return
+
+        gifted_text = ", ".join(moved_names)
+        reply = f"Success! Aapne '{gifted_text}' ko @{target_username} ko gift kar diya hai."
+        if skipped:
+            reply += f"\n@{target_username} ke paas pehle se hain (gift nahi hue): {', '.join(skipped)}"
+        if missing:
+            reply += f"\nAapke paas nahi the: {', '.join(missing)}"
+        await update.message.reply_text(reply)
         
         try:
             await context.bot.send_message(
                 chat_id=target_user_id,
-                text=f"Tohfa! {gifter_user_name} ne aapko **{character_name}** gift kiya hai! 🎉"
+                text=f"Tohfa! {gifter_user_name} ne aapko **{gifted_text}** gift kiya hai! 🎉"
             )
         except Exception as e:
             logger.warning(f"Gift DM failed: {e}")
@@ -471,20 +1142,24 @@ async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Agar query empty hai, toh recently added characters dikhayein
     if not query:
         results_data = execute_query(
-             "SELECT name, image_url, char_id, rarity, anime FROM characters ORDER BY char_id DESC LIMIT 30;",
+             "SELECT name, image_url, char_id, rarity, anime, thumbnail_url FROM characters ORDER BY char_id DESC LIMIT 30;",
              fetch=True
         )
     else:
         # Search query ke anusaar characters khojein (case-insensitive search)
         results_data = execute_query(
-            "SELECT name, image_url, char_id, rarity, anime FROM characters WHERE name ILIKE %s LIMIT 30;",
+            "SELECT name, image_url, char_id, rarity, anime, thumbnail_url FROM characters WHERE name ILIKE %s LIMIT 30;",
             (f"%{query}%",), fetch=True
         )
 
     results = []
     
-    for name, image_url, char_id, rarity, anime in results_data:
+    for name, image_url, char_id, rarity, anime, thumbnail_url in results_data or []:
         
+        if not thumbnail_url:
+            # Purane characters ka thumbnail background mein ban jayega, tab tak full image
+            context.application.create_task(ensure_thumbnail(image_url))
+
         message_content = f"✨ **{name}** ✨\n" \
                           f"**Rarity:** {rarity}\n" \
                           f"**Anime:** {anime}\n" \
@@ -495,7 +1170,7 @@ async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineQueryResultPhoto(
                 id=str(uuid.uuid4()), 
                 photo_url=image_url,
-                thumbnail_url=image_url,
+                thumbnail_url=thumbnail_url or image_url,
                 title=f"{imode_text}: {name}",
                 caption=f"**{name}**\nRarity: {rarity}",
                 parse_mode=ParseMode.MARKDOWN,
@@ -523,40 +1198,41 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # --- GRAB LOGIC (Same as grab_command) ---
     if query.data == "grab_waifu":
-        if chat_id not in current_spawns or current_spawns[chat_id].get('claimed', True):
+        spawned_waifu = get_active_spawn(chat_id)
+        if spawned_waifu is None or spawned_waifu.message_id != query.message.message_id:
             await query.edit_message_caption(caption="Bahut der kardi! 🥺")
             return
-            
-        spawned_waifu = current_spawns[chat_id]
         
         check_query = """SELECT c.name FROM user_collection uc JOIN characters c ON uc.char_id = c.char_id WHERE uc.user_id = %s AND c.name = %s;"""
-        if execute_query(check_query, (user_id, spawned_waifu['name']), fetch=True):
-             await query.message.reply_text(f"**{query.from_user.first_name}** ne **{spawned_waifu['name']}** ko grab karne ki koshish ki, lekin unke paas yeh pehle se hai!", parse_mode=ParseMode.MARKDOWN)
-             current_spawns[chat_id]['claimed'] = True
+        if execute_query(check_query, (user_id, spawned_waifu.name), fetch=True):
+             claim_spawn(chat_id, spawned_waifu)
+             await query.message.reply_text(f"**{query.from_user.first_name}** ne **{spawned_waifu.name}** ko grab karne ki koshish ki, lekin unke paas yeh pehle se hai!", parse_mode=ParseMode.MARKDOWN)
              await query.edit_message_reply_markup(reply_markup=None) # Remove button
              return
 
         execute_query(
             "INSERT INTO characters (name, image_url, rarity, anime) VALUES (%s, %s, %s, %s) ON CONFLICT (name) DO UPDATE SET image_url = EXCLUDED.image_url, rarity = EXCLUDED.rarity, anime = EXCLUDED.anime;",
-            (spawned_waifu['name'], spawned_waifu['image'], spawned_waifu['rarity'], spawned_waifu['anime'])
+            (spawned_waifu.name, spawned_waifu.image, spawned_waifu.rarity, spawned_waifu.anime)
         )
         
-        char_id_result = execute_query("SELECT char_id FROM characters WHERE name = %s;", (spawned_waifu['name'],), fetch=True)
+        char_id_result = execute_query("SELECT char_id FROM characters WHERE name = %s;", (spawned_waifu.name,), fetch=True)
         
         if char_id_result:
             char_id = char_id_result[0][0]
-            execute_query("INSERT INTO user_collection (user_id, char_id) VALUES (%s, %s);", (user_id, char_id))
-            current_spawns[chat_id]['claimed'] = True
+            if not claim_spawn(chat_id, spawned_waifu):
+                await query.edit_message_caption(caption="Bahut der kardi! 🥺")
+                return
+            record_grab(user_id, char_id, chat_id)
             
             await query.edit_message_caption(
-                caption=f"✨ **{spawned_waifu['name']}** ({spawned_waifu['rarity']}) ✨\n\n💖 **Grabbed by: {query.from_user.first_name}** 💖",
+                caption=f"✨ **{spawned_waifu.name}** ({spawned_waifu.rarity}) ✨\n\n💖 **Grabbed by: {query.from_user.first_name}** 💖",
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=None # Remove the button
             )
             
             await context.bot.send_message(
                 chat_id=chat_id,
-                text=f"🎉 Badhaai ho, **{query.from_user.first_name}**! Aapne **{spawned_waifu['name']}** ko apne harem mein shaamil kar liya hai!",
+                text=f"🎉 Badhaai ho, **{query.from_user.first_name}**! Aapne **{spawned_waifu.name}** ko apne harem mein shaamil kar liya hai!",
                 parse_mode=ParseMode.MARKDOWN
             )
         else:
@@ -573,7 +1249,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         action, trade_id = query.data.split('_', 2)[1:]
         
         trade_data = execute_query(
-            "SELECT from_user_id, to_user_id, from_char_name, to_char_name, status FROM pending_trades WHERE trade_id = %s;",
+            "SELECT from_user_id, to_user_id, from_char_name, to_char_name, status, from_char_ids, to_char_ids FROM pending_trades WHERE trade_id = %s;",
             (trade_id,), fetch=True
         )
         
@@ -581,7 +1257,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("Yeh trade request expire ho chuki hai ya pehle hi process ho chuki hai.")
             return
 
-        from_id, to_id, from_char, to_char, status = trade_data[0]
+        from_id, to_id, from_char, to_char, status, from_char_ids, to_char_ids = trade_data[0]
         
         if user_id != to_id:
             await query.answer("Yeh trade request aapke liye nahi hai!", show_alert=True)
@@ -596,28 +1272,67 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         receiver_name = query.from_user.first_name # The one who accepted/rejected
 
         if action == "accept":
-            # Char IDs ko dobara fetch karna for safety, using ILIKE for flexibility
-            from_char_id_result = execute_query("SELECT char_id FROM characters WHERE name ILIKE %s;", (from_char,), fetch=True)
-            to_char_id_result = execute_query("SELECT char_id FROM characters WHERE name ILIKE %s;", (to_char,), fetch=True)
-            
-            if not from_char_id_result or not to_char_id_result:
-                 await query.edit_message_text("Trade fail: Character ID nahi mila (ya naam match nahi hua).")
+            if from_char_ids is None or to_char_ids is None:
+                # Purane (ek-ke-badle-ek) trades mein sirf naam save hain
+                from_ids_result = execute_query("SELECT char_id FROM characters WHERE name ILIKE %s;", (from_char,), fetch=True)
+                to_ids_result = execute_query("SELECT char_id FROM characters WHERE name ILIKE %s;", (to_char,), fetch=True)
+                if not from_ids_result or not to_ids_result:
+                     await query.edit_message_text("Trade fail: Character ID nahi mila (ya naam match nahi hua).")
+                     return
+                from_char_ids, to_char_ids = [from_ids_result[0][0]], [to_ids_result[0][0]]
+
+            # Ek hi statement: dono users ki relevant rows lock karke ownership check, aur check pass ho
+            # tabhi status claim + swap + stats. Beech mein koi gift/trade ho toh bhi aadha swap nahi hota.
+            result = execute_query(
+                """
+                WITH locked AS (
+                    SELECT user_id, char_id FROM user_collection
+                    WHERE user_id IN (%(from_id)s, %(to_id)s) AND char_id = ANY(%(all_ids)s)
+                    FOR UPDATE
+                ), ownership AS (
+                    SELECT
+                        COUNT(*) FILTER (WHERE user_id = %(from_id)s AND char_id = ANY(%(from_ids)s)) = %(from_count)s
+                        AND COUNT(*) FILTER (WHERE user_id = %(to_id)s AND char_id = ANY(%(to_ids)s)) = %(to_count)s
+                        AND COUNT(*) FILTER (WHERE (user_id = %(from_id)s AND char_id = ANY(%(to_ids)s))
+                                              OR (user_id = %(to_id)s AND char_id = ANY(%(from_ids)s))) = 0 AS ok
+                    FROM locked
+                ), claimed AS (
+                    UPDATE pending_trades SET status = 'ACCEPTED'
+                    WHERE trade_id = %(trade_id)s AND status = 'PENDING' AND (SELECT ok FROM ownership)
+                    RETURNING trade_id
+                ), swapped AS (
+                    UPDATE user_collection SET user_id = CASE WHEN user_id = %(from_id)s THEN %(to_id)s ELSE %(from_id)s END
+                    WHERE EXISTS (SELECT 1 FROM claimed)
+                      AND ((user_id = %(from_id)s AND char_id = ANY(%(from_ids)s)) OR (user_id = %(to_id)s AND char_id = ANY(%(to_ids)s)))
+                    RETURNING char_id
+                ), stats AS (
+                    UPDATE user_profiles SET trades_done = trades_done + 1
+                    WHERE user_id IN (%(from_id)s, %(to_id)s) AND EXISTS (SELECT 1 FROM claimed)
+                )
+                SELECT
+                    (SELECT ok FROM ownership),
+                    (SELECT COUNT(*) FROM claimed),
+                    -- Safety net: claim hua par poora swap nahi hua toh division by zero se poora statement rollback
+                    (SELECT COUNT(*) FROM swapped) / CASE WHEN (SELECT COUNT(*) FROM claimed) = 0
+                        OR (SELECT COUNT(*) FROM swapped) = %(from_count)s + %(to_count)s THEN 1 ELSE 0 END;
+                """,
+                {'trade_id': trade_id, 'from_id': from_id, 'to_id': to_id,
+                 'from_ids': list(from_char_ids), 'to_ids': list(to_char_ids),
+                 'all_ids': list(set(from_char_ids) | set(to_char_ids)),
+                 'from_count': len(from_char_ids), 'to_count': len(to_char_ids)},
+                fetch=True
+            )
+            if not result:
+                 logger.error(f"Trade {trade_id} accept failed; statement rolled back.")
+                 await query.edit_message_text("Trade fail: DB error hua, kuch bhi transfer nahi hua. Dobara try karein.")
+                 return
+            ownership_ok, claimed_count, _ = result[0]
+            if not ownership_ok:
+                 await query.edit_message_text("Trade fail: Kisi ke paas ab zaroori characters nahi hain (ya pehle se dono ke paas hain).")
+                 return
+            if not claimed_count:
+                 await query.edit_message_text("Trade fail: Yeh trade pehle hi process ho chuka hai.")
                  return
-                 
-            from_char_id = from_char_id_result[0][0]
-            to_char_id = to_char_id_result[0][0]
-
-            # 1. Receiver ka char (to_char) Giver ko dena
-            execute_query("DELETE FROM user_collection WHERE user_id = %s AND char_id = %s;", (to_id, to_char_id))
-            execute_query("INSERT INTO user_collection (user_id, char_id) VALUES (%s, %s);", (from_id, to_char_id))
-            
-            # 2. Giver ka char (from_char) Receiver ko dena
-            execute_query("DELETE FROM user_collection WHERE user_id = %s AND char_id = %s;", (from_id, from_char_id))
-            execute_query("INSERT INTO user_collection (user_id, char_id) VALUES (%s, %s);", (to_id, from_char_id))
-            
-            # 3. Trade stats update karna
-            execute_query("UPDATE user_profiles SET trades_done = trades_done + 1 WHERE user_id IN (%s, %s);", (from_id, to_id))
-            execute_query("UPDATE pending_trades SET status = 'ACCEPTED' WHERE trade_id = %s;", (trade_id,))
             
             await query.edit_message_text(f"✅ Trade Accepted! Aapne '{to_char}' dekar '{from_char}' le liya hai.")
             
@@ -658,8 +1373,9 @@ async def message_counter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.chat_data['message_count'] += 1
     
     if context.chat_data['message_count'] >= SPAWN_THRESHOLD:
-        await spawn_waifu(context, chat_id)
-        context.chat_data['message_count'] = 0 
+        # Spawn worker pool mein jaata hai; queue full ho toh counter rehne do (agle message par retry)
+        if enqueue_spawn(context, chat_id):
+            context.chat_data['message_count'] = 0 
         
 # --- PLACEHOLDER FUNCTIONS (Minimal working versions) ---
 
@@ -670,6 +1386,25 @@ async def changetime_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     await update.message.reply_text("Spawn time changed (Implementation pending).")
 
+async def dedupe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command: duplicate characters merge karta hai aur collections repoint karta hai."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("Aap yeh command use nahi kar sakte.")
+        return
+    await update.message.reply_text("Duplicate characters merge ho rahe hain, thoda intezaar karein...")
+    backfilled, merged = await asyncio.to_thread(dedupe_characters)
+    await update.message.reply_text(f"✅ Dedupe complete! {backfilled} rows backfill hui, {merged} duplicate characters merge hue.")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command: bot ke internal metrics dikhata hai."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("Aap yeh command use nahi kar sakte.")
+        return
+    await update.message.reply_text(
+        format_spawn_metrics() + "\n\n" + format_spawn_registry_metrics() + "\n\n" + format_admission_metrics(),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
 async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/top redirects to /gtop (leaderboard)."""
     await leaderboard_command(update, context)
@@ -695,6 +1430,26 @@ def fetch_leaderboard_data(time_period='global'):
         text += f"{i+1}. {name}: **{count}** waifus\n"
     return text
 
+def fetch_chat_leaderboard_data(chat_id, chat_title):
+    """Ek group ka leaderboard (chat_user_grabs ke chhote indexed rows se)."""
+    results = execute_query(
+        """
+        SELECT u.first_name, g.grabs
+        FROM chat_user_grabs g
+        JOIN users u ON u.user_id = g.user_id
+        WHERE g.chat_id = %s
+        ORDER BY g.grabs DESC
+        LIMIT 10;
+        """, (chat_id,), fetch=True
+    )
+    if not results:
+        return "Is group mein abhi tak kisi ne waifu grab nahi ki. Pehli waifu grab karein!"
+
+    text = f"🏆 **{chat_title} - Top 10 Grabbers** 🏆\n\n"
+    for i, (name, count) in enumerate(results):
+        text += f"{i+1}. {name}: **{count}** grabs\n"
+    return text
+
 def get_leaderboard_markup(time_period):
     """Leaderboard buttons create karta hai."""
     keyboard = [
@@ -717,6 +1472,18 @@ async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         reply_markup=reply_markup
     )
 
+async def chat_leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/ctop: Is group ka leaderboard dikhata hai."""
+    chat = update.effective_chat
+    if chat.type == "private":
+        await update.message.reply_text("/ctop sirf groups mein kaam karta hai. Global ranking ke liye /gtop use karein.")
+        return
+
+    await update.message.reply_text(
+        fetch_chat_leaderboard_data(chat.id, chat.title or "Group"),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/status: User ka profile aur stats dikhata hai."""
     user_id = update.effective_user.id
@@ -737,12 +1504,25 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     trades_done, gifts_sent, gifts_received, hmode_text, imode_text = profile_data[0] if profile_data else (0, 0, 0, "Harem Collection", "Inline Waifus")
     total_waifus = count_data[0][0] if count_data else 0
 
+    # 3. Group mein ho toh is group ke grabs aur rank
+    chat_stats_text = ""
+    chat = update.effective_chat
+    if chat.type != "private":
+        chat_data = execute_query(
+            "SELECT g.grabs, (SELECT COUNT(*) + 1 FROM chat_user_grabs o WHERE o.chat_id = g.chat_id AND o.grabs > g.grabs) FROM chat_user_grabs g WHERE g.chat_id = %s AND g.user_id = %s;",
+            (chat.id, user_id),
+            fetch=True
+        )
+        chat_grabs, chat_rank = chat_data[0] if chat_data else (0, None)
+        chat_stats_text = f"🏠 **Is Group Mein Grabs:** {chat_grabs}" + (f" (Rank #{chat_rank})" if chat_rank else "") + "\n"
+
     status_text = (
         f"👤 **{update.effective_user.first_name}'s Profile Status** 📊\n\n"
         f"💖 **Total Waifus:** {total_waifus}\n"
         f"🔄 **Trades Done:** {trades_done}\n"
         f"🎁 **Gifts Sent:** {gifts_sent}\n"
-        f"🧧 **Gifts Received:** {gifts_received}\n\n"
+        f"🧧 **Gifts Received:** {gifts_received}\n"
+        f"{chat_stats_text}\n"
         f"🔧 **Current Settings:**\n"
         f"  • /harem Mode: `{hmode_text}`\n"
         f"  • /search Mode: `{imode_text}`"
@@ -773,6 +1553,65 @@ async def imode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     execute_query("UPDATE user_profiles SET imode_text = %s WHERE user_id = %s;", (new_text, user_id))
     await update.message.reply_text(f"✅ Success! Aapki Inline Search Gallery ab **'{new_text}'** ke title se dikhegi.")
 
+# --- WEBHOOK SERVER (Telegram updates + thumbnails) ---
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    """Telegram ke webhook POST ko PTB application ki update queue mein daalta hai."""
+
+    def initialize(self, ptb_application):
+        self.ptb_application = ptb_application
+
+    async def post(self):
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.ptb_application.bot)
+        except Exception as e:
+            logger.warning(f"Invalid webhook payload: {e}")
+            self.set_status(400)
+            return
+        await self.ptb_application.update_queue.put(update)
+
+class ThumbnailHandler(tornado.web.StaticFileHandler):
+    """Cache se thumbnails serve karta hai. Filenames content hash hain, toh lamba cache safe hai."""
+
+    def set_extra_headers(self, path):
+        self.set_header("Cache-Control", "public, max-age=31536000, immutable")
+
+async def run_webhook_server(application):
+    """Ek hi port par Telegram webhook aur /thumbs/ dono serve karta hai."""
+    os.makedirs(THUMB_DIR, exist_ok=True)
+    web_app = tornado.web.Application([
+        (rf"/{TELEGRAM_TOKEN}", TelegramWebhookHandler, {"ptb_application": application}),
+        (rf"/{THUMB_URL_PATH}/([0-9a-f]{{64}}\.(?:jpg|webp))", ThumbnailHandler, {"path": THUMB_DIR}),
+    ])
+
+    # Render redeploy par SIGTERM aata hai; run_webhook ki tarah graceful shutdown ke liye stop event set karo
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass # Windows par signal handlers support nahi hote
+
+    async with application:
+        # Sirf wahi update types jo handlers use karte hain (reactions/chat_member wagairah admission buckets na khaayein).
+        # Explicit list zaroori hai: unset chhodne par Telegram pichhli setting hi rakhta hai.
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}",
+            allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
+        )
+        await application.start()
+        start_spawn_workers(application)
+        server = web_app.listen(PORT, address="0.0.0.0")
+        try:
+            await stop_event.wait() # Signal aane tak chalta rahe
+            logger.info("Stop signal mila, bot band ho raha hai...")
+        finally:
+            server.stop()
+            await stop_spawn_workers()
+            await application.stop()
+            thumb_executor.shutdown(wait=False)
+
 # --- WEBHOOK MAIN FUNCTION ---
 
 def main():
@@ -787,6 +1626,9 @@ def main():
 
     application = Application.builder().token(TELEGRAM_TOKEN).build()
 
+    # Admission gate: har update par pehle (group -1), flood yahin drop hota hai
+    application.add_handler(TypeHandler(Update, admission_gate), group=-1)
+
     # Command Handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
@@ -794,10 +1636,13 @@ def main():
     application.add_handler(CommandHandler("harem", harem_command))
     application.add_handler(CommandHandler("search", search_command))
     application.add_handler(CommandHandler("changetime", changetime_command))
+    application.add_handler(CommandHandler("dedupe", dedupe_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("top", top_command)) # Alias for /gtop
     application.add_handler(CommandHandler("trade", trade_command))
     application.add_handler(CommandHandler("gift", gift_command))
     application.add_handler(CommandHandler("gtop", leaderboard_command))
+    application.add_handler(CommandHandler("ctop", chat_leaderboard_command))
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CommandHandler("hmode", hmode_command))
     application.add_handler(CommandHandler("imode", imode_command))
@@ -809,15 +1654,16 @@ def main():
     # INLINE QUERY HANDLER (For the gallery search)
     application.add_handler(InlineQueryHandler(inline_search))
     
-    # Run in Webhook mode for Render Web Service
+    # Run in Webhook mode for Render Web Service (thumbnails bhi isi server se)
     print(f"Setting webhook to {WEBHOOK_URL} on port {PORT}...")
     
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path=TELEGRAM_TOKEN,
-        webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}"
-    )
+    if Image is None:
+        logger.warning("Pillow installed nahi hai, inline gallery full images ko hi thumbnail use karegi.")
+
+    try:
+        asyncio.run(run_webhook_server(application))
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Bot shutting down.")
 
 
 if __name__ == "__main__":